@@ -2,7 +2,7 @@ from fastapi import FastAPI, Query
 from pydantic import BaseModel
 from typing import List, Dict, Any, Tuple
 from pathlib import Path
-import json, re, pickle, yaml, numpy as np
+import asyncio, json, re, pickle, threading, yaml, numpy as np
 import chromadb
 from whoosh import index as wx, qparser, query as Q, spans as S
 import faiss
@@ -12,10 +12,22 @@ CFG  = yaml.safe_load(open(BASE/"ingest"/"config.yaml","r",encoding="utf-8"))
 
 # --- Embedder (TF-IDF→SVD) ---
 PIPE = pickle.load(open(BASE/"models"/"tfidf_svd_384.pkl","rb"))
+# unpack the pipeline once: per-query Pipeline.transform dispatch is pure overhead
+try:
+    _TFIDF = PIPE.steps[0][1]
+    _SVD_T = PIPE.steps[-1][1].components_.T.astype(np.float32).copy(order="C")
+except (AttributeError, IndexError):
+    _TFIDF = None; _SVD_T = None
+
 def _pipe_transform(texts: List[str]) -> np.ndarray:
-    m = PIPE.transform(texts); m = m.toarray() if hasattr(m,"toarray") else m
-    m = m.astype(np.float32); n = np.linalg.norm(m,axis=1,keepdims=True)+1e-9
-    return m / n
+    """Embed texts to unit-norm float32 rows (TF-IDF sparse @ SVD components)."""
+    if _TFIDF is not None:
+        m = np.asarray(_TFIDF.transform(texts) @ _SVD_T, dtype=np.float32)
+    else:
+        m = PIPE.transform(texts); m = m.toarray() if hasattr(m,"toarray") else m
+        m = m.astype(np.float32)
+    n = np.sqrt(np.einsum('ij,ij->i', m, m)) + 1e-9
+    return m / n[:, None]
 
 # --- Chroma client ---
 client = chromadb.HttpClient(
@@ -25,61 +37,122 @@ client = chromadb.HttpClient(
 
 # --- FAISS: load per app ---
 FAISS_DIR = BASE / "faiss"
+FAISS_NPROBE = int(CFG.get("faiss", {}).get("nprobe", 16)) if isinstance(CFG.get("faiss"), dict) else 16
 FAISS_IDX: Dict[str, faiss.Index] = {}
-FAISS_IDS: Dict[str, List[str]] = {}
+FAISS_IDS: Dict[str, np.ndarray] = {}  # fixed-width bytes, row i -> chunk id
+
+def _load_ids(app: str) -> np.ndarray:
+    npy_p = FAISS_DIR / f"{app}_ids.npy"
+    if npy_p.exists():
+        # mmap: no per-id Python objects until a hit is decoded
+        return np.load(npy_p, mmap_mode="r")
+    json_p = FAISS_DIR / f"{app}_ids.json"  # pre-npy ingest artifacts
+    if json_p.exists():
+        return np.array(json.load(open(json_p, "r", encoding="utf-8")), dtype="S")
+    return np.empty(0, dtype="S1")
 
 def load_faiss_for_app(app: str):
     if app in FAISS_IDX: return
     idx_p = FAISS_DIR / f"{app}.faiss"
-    ids_p = FAISS_DIR / f"{app}_ids.json"
-    if idx_p.exists() and ids_p.exists():
-        FAISS_IDX[app] = faiss.read_index(str(idx_p))
-        FAISS_IDS[app] = json.load(open(ids_p, "r", encoding="utf-8"))
+    ids = _load_ids(app)
+    if idx_p.exists() and len(ids):
+        idx = faiss.read_index(str(idx_p))
+        if hasattr(idx, "nprobe"):  # IVF/IVF-PQ indexes built by ingest
+            idx.nprobe = FAISS_NPROBE
+        FAISS_IDX[app] = idx
+        FAISS_IDS[app] = ids
     else:
         FAISS_IDX[app] = None
-        FAISS_IDS[app] = []
+        FAISS_IDS[app] = np.empty(0, dtype="S1")
 
 # --- Whoosh index dir ---
 IX_DIR = BASE / "data" / "whoosh"
+_WHOOSH: Dict[str, Tuple[Any, Any]] = {}  # app -> (ix, searcher)
+_WHOOSH_LOCK = threading.Lock()
+
+def get_searcher(app: str):
+    # searches run in worker threads now, so guard the cache
+    with _WHOOSH_LOCK:
+        entry = _WHOOSH.get(app)
+        if entry is None:
+            ixp = IX_DIR / app
+            if not ixp.exists(): return None
+            ix = wx.open_dir(ixp)
+            entry = _WHOOSH[app] = (ix, ix.searcher())
+        ix, s = entry
+        s2 = s.refresh()  # no-op unless the index version changed
+        if s2 is not s:
+            _WHOOSH[app] = (ix, s2)
+        return _WHOOSH[app][1]
 
 STOP = set("""the a an and or of for to in on with by from as is are be was were it this that these those""".split())
 DOMAIN_STOP = set(["claim","claims","policy","process","team","user"])  # extend if noisy
+ALL_STOP = frozenset(STOP | DOMAIN_STOP)
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+")
+_MUST_SPLIT_RE = re.compile(r"[,\s]+")
+
+_APP2NAME = { c["app"]: c["name"] for c in CFG["collections"] }
+_COLL_CACHE: Dict[str, Any] = {}
 
 def pick_collection(app: str) -> str:
-    m = { c["app"]: c["name"] for c in CFG["collections"] }
-    return m.get(app, next(iter(m.values())))
+    return _APP2NAME.get(app, next(iter(_APP2NAME.values())))
+
+def get_collection(app: str):
+    coll = _COLL_CACHE.get(app)
+    if coll is None:
+        coll = _COLL_CACHE[app] = client.get_or_create_collection(pick_collection(app))
+    return coll
 
 def tokenize(s: str) -> List[str]:
-    return [w for w in re.findall(r"[A-Za-z0-9_]+", s.lower()) if w]
+    return [w for w in _TOKEN_RE.findall(s.lower()) if w]
 
-def rrf_union(rankings: List[Dict[str,int]], k: int = 60):
-    from collections import defaultdict
-    s=defaultdict(float)
+def rrf_union(rankings: List[Dict[str,int]], k: int = 60, limit: int = None):
+    ids = list(dict.fromkeys(did for ranks in rankings for did in ranks))
+    if not ids: return []
+    id2idx = {did: i for i, did in enumerate(ids)}
+    scores = np.zeros(len(ids), dtype=np.float64)
     for ranks in rankings:
-        for did, r in ranks.items(): s[did]+=1.0/(k+r)
-    return sorted(s.items(), key=lambda x:-x[1])
+        if not ranks: continue
+        idxs = np.fromiter((id2idx[d] for d in ranks), dtype=np.int64, count=len(ranks))
+        rs = np.fromiter(ranks.values(), dtype=np.float64, count=len(ranks))
+        scores[idxs] += 1.0/(k+rs)
+    if limit is not None and limit < len(ids):
+        # only the top slice needs ordering; select then sort it
+        part = np.argpartition(-scores, limit)[:limit]
+        order = part[np.argsort(-scores[part], kind="stable")]
+    else:
+        order = np.argsort(-scores, kind="stable")
+    return [(ids[i], float(scores[i])) for i in order]
 
 def mmr(candidate_vecs, query_vec, top_n=8, lam=0.7):
-    cand = np.array(candidate_vecs, dtype="float32")
-    q = np.array(query_vec, dtype="float32")
+    # expects unit-norm rows (what _pipe_transform returns): every similarity
+    # below is then a plain dot product, no norm divisions anywhere
+    cand = np.asarray(candidate_vecs, dtype=np.float32)
+    q = np.asarray(query_vec, dtype=np.float32)
     if cand.size == 0: return []
-    sim_q=(cand@q)/(np.linalg.norm(cand,axis=1)*np.linalg.norm(q)+1e-9)
-    selected,rest=[],list(range(len(candidate_vecs)))
-    while rest and len(selected)<top_n:
+    sim_q = cand @ q
+    G = cand @ cand.T  # one SGEMM; shortlist is small (<= pool)
+    n = len(cand)
+    max_sim = np.full(n, -np.inf, dtype=np.float32)  # max sim to any selected row
+    picked_mask = np.zeros(n, dtype=bool)
+    selected: List[int] = []
+    while len(selected) < min(top_n, n):
         if not selected:
-            i=int(np.argmax(sim_q[rest])); selected.append(rest.pop(i)); continue
-        sel=cand[selected]
-        sim_div=cand[rest]@sel.T
-        sim_div=(sim_div/(np.linalg.norm(cand[rest],axis=1,keepdims=True)*np.linalg.norm(sel,axis=1)+1e-9)).max(axis=1)
-        score=lam*sim_q[rest]-(1-lam)*sim_div
-        j=int(np.argmax(score)); selected.append(rest.pop(j))
+            score = sim_q.copy()
+        else:
+            score = lam*sim_q - (1-lam)*max_sim
+        score[picked_mask] = -np.inf
+        j = int(np.argmax(score))
+        selected.append(j); picked_mask[j] = True
+        # diversity penalties for the next round come straight from the gram matrix
+        max_sim = np.maximum(max_sim, G[:, j])
     return selected
 
 def keyword_hits(text: str, terms: List[str]) -> set:
     return set(tokenize(text or "")).intersection(set(terms))
 
-def phrase_present(text: str, phrase: str, prox: int = 0) -> bool:
-    words=tokenize(text or ""); p=tokenize(phrase)
+def _phrase_in_tokens(words: List[str], p: List[str], prox: int = 0) -> bool:
     if not p or len(words)<len(p): return False
     if prox<=0: return (" ".join(p) in " ".join(words))
     idxs=[i for i,w in enumerate(words) if w==p[0]]
@@ -88,9 +161,25 @@ def phrase_present(text: str, phrase: str, prox: int = 0) -> bool:
         if all(any(w2==pw for w2 in win) for pw in p): return True
     return False
 
-def coverage_score(doc_text: str, req_terms: List[str], req_phrases: List[str], proximity: int):
-    hits = keyword_hits(doc_text, req_terms) if req_terms else set()
-    ph_ok = {p: phrase_present(doc_text, p, prox=proximity) for p in req_phrases}
+def phrase_present(text: str, phrase: str, prox: int = 0) -> bool:
+    return _phrase_in_tokens(tokenize(text or ""), tokenize(phrase), prox)
+
+def coverage_score(doc_text: str, req_terms: List[str], req_phrases: List[str], proximity: int,
+                   phrase_tokens: List[List[str]] = None):
+    # tokenize the doc once; terms check the set, phrases scan the list
+    words = tokenize(doc_text or "")
+    hits = set(words).intersection(req_terms) if req_terms else set()
+    if phrase_tokens is None:
+        phrase_tokens = [tokenize(p) for p in req_phrases]
+    # join the doc once and substring-scan every exact phrase against it;
+    # only proximity matches still need the token-window walk
+    joined = " ".join(words) if (req_phrases and proximity <= 0) else None
+    ph_ok = {}
+    for p, toks in zip(req_phrases, phrase_tokens):
+        if proximity <= 0:
+            ph_ok[p] = bool(toks) and len(words) >= len(toks) and (" ".join(toks) in joined)
+        else:
+            ph_ok[p] = _phrase_in_tokens(words, toks, proximity)
     cov = 0.0
     if req_terms:   cov += len(hits)/max(1,len(req_terms))
     if req_phrases: cov += sum(1.0 if ok else 0.0 for ok in ph_ok.values())/max(1,len(req_phrases))
@@ -98,6 +187,20 @@ def coverage_score(doc_text: str, req_terms: List[str], req_phrases: List[str],
 
 app = FastAPI(title="Hybrid Retrieval (FAISS + Whoosh + Chroma)")
 
+@app.on_event("startup")
+def _warm():
+    # pay index loads and BLAS/sklearn dispatch at boot, not on the first request
+    for c in CFG["collections"]:
+        load_faiss_for_app(c["app"])
+        get_searcher(c["app"])
+    _pipe_transform(["warmup"])
+
+@app.on_event("shutdown")
+def _close_searchers():
+    for _, s in _WHOOSH.values():
+        try: s.close()
+        except Exception: pass
+
 class RetrieveResponse(BaseModel):
     query: str
     app: str
@@ -106,7 +209,7 @@ class RetrieveResponse(BaseModel):
     debug: Dict[str, Any]
 
 @app.get("/retrieve", response_model=RetrieveResponse)
-def retrieve(
+async def retrieve(
     q: str = Query(...),
     app_name: str = Query("claims"),
     top_k: int = Query(8),
@@ -121,9 +224,12 @@ def retrieve(
     proximity: int = Query(0, description="phrase proximity window (0=exact)")
 ):
     # normalize requireds
-    req_terms = [t for t in re.split(r"[,\s]+", must.strip()) if t]
-    req_terms = [t.lower() for t in req_terms if t.lower() not in STOP and t.lower() not in DOMAIN_STOP]
+    req_terms = [t for t in _MUST_SPLIT_RE.split(must.strip()) if t]
+    req_terms = [t.lower() for t in req_terms if t.lower() not in ALL_STOP]
     req_phrases = [p.strip() for p in must_phrases.split(";") if p.strip()]
+    req_phrase_tokens = [tokenize(p) for p in req_phrases]
+    req_need = (min_hits if min_hits>0 else len(req_terms))
+    base_terms = [w for w in tokenize(q) if w not in ALL_STOP][:8]
 
     # prepare holders
     vranks: Dict[str,int] = {}     # vector ranks (FAISS or Chroma)
@@ -132,49 +238,70 @@ def retrieve(
     cand_docs: List[str] = []
     cand_meta: List[Dict[str,Any]] = []
 
-    coll = client.get_or_create_collection(pick_collection(app_name))
+    coll = get_collection(app_name)
+
+    # embed the query once; every consumer below reuses one of these forms
+    qv_mat = _pipe_transform([q])
+    qv_np = qv_mat[0]
 
     # --- Vector side: FAISS or Chroma ---
-    if signal in ("hybrid","faiss","chroma"):
-        if signal in ("hybrid","faiss"):
-            load_faiss_for_app(app_name)
-            idx = FAISS_IDX.get(app_name); idlist = FAISS_IDS.get(app_name, [])
-            if idx is not None and idlist:
-                qv = _pipe_transform([q])
-                D,I = idx.search(qv, max(pool, top_k*6))
-                for rank, pos in enumerate(I[0].tolist(), start=1):
-                    if pos == -1: continue
-                    did = idlist[pos]
-                    vranks[did] = rank
-        if signal == "chroma":
-            qv = _pipe_transform([q])[0].tolist()
-            vres = coll.query(query_embeddings=[qv], n_results=max(pool, top_k*6), where={"app": app_name})
+    def vector_search() -> Dict[str,int]:
+        vr: Dict[str,int] = {}
+        load_faiss_for_app(app_name)
+        idx = FAISS_IDX.get(app_name); idlist = FAISS_IDS.get(app_name)
+        if idx is not None and idlist is not None and len(idlist):
+            # in-process ANN; Chroma's query path is brute-force server-side
+            if hasattr(idx, "hnsw"):
+                idx.hnsw.efSearch = max(64, pool)
+            D,I = idx.search(qv_mat, max(pool, top_k*6))
+            for rank, pos in enumerate(I[0].tolist(), start=1):
+                if pos == -1: continue
+                did = idlist[pos].decode("utf-8")
+                vr[did] = rank
+        elif signal == "chroma":
+            # no local index for this app; fall back to server-side search
+            vres = coll.query(query_embeddings=[qv_np.tolist()], n_results=max(pool, top_k*6), where={"app": app_name})
             v_ids = vres.get("ids",[[]])[0] or []
-            vranks = {v_ids[i]: i+1 for i in range(len(v_ids))}
+            vr = {v_ids[i]: i+1 for i in range(len(v_ids))}
+        return vr
 
     # --- BM25 (Whoosh) ---
-    if signal in ("hybrid","bm25"):
-        ixp = IX_DIR / app_name
-        if ixp.exists():
-            with wx.open_dir(ixp).searcher() as s:
-                # Build an AND query with optional proximity phrases
-                clauses: List[Q.Query] = []
-                base_terms = [w for w in tokenize(q) if w not in STOP|DOMAIN_STOP][:8]
-                for w in base_terms: clauses.append(Q.Term("text", w))
-                for t in req_terms:  clauses.append(Q.Term("text", t))
-                for phr in req_phrases:
-                    toks = tokenize(phr)
-                    if toks:
-                        if proximity and proximity>0:
-                            clauses.append(S.SpanNear(*(Q.Term("text", x) for x in toks), slop=proximity))
-                        else:
-                            clauses.append(Q.Phrase("text", toks))
-                qobj = Q.And(clauses) if clauses else Q.Every()
-                bres = s.search(qobj, limit=max(pool, top_k*6))
-                branks = { r["doc_id"]: i+1 for i,r in enumerate(bres) }
+    def bm25_search() -> Dict[str,int]:
+        br: Dict[str,int] = {}
+        s = get_searcher(app_name)
+        if s is not None:
+            # Build an AND query with optional proximity phrases
+            clauses: List[Q.Query] = []
+            for w in base_terms: clauses.append(Q.Term("text", w))
+            if req_terms:
+                # enforce the min_hits contract in the index, not post-hoc
+                tq = [Q.Term("text", t) for t in req_terms]
+                clauses.append(Q.Or(tq, minmatch=req_need) if req_need < len(req_terms) else Q.And(tq))
+            for toks in req_phrase_tokens:
+                if toks:
+                    if proximity and proximity>0:
+                        clauses.append(S.SpanNear(*(Q.Term("text", x) for x in toks), slop=proximity))
+                    else:
+                        clauses.append(Q.Phrase("text", toks))
+            qobj = Q.And(clauses) if clauses else Q.Every()
+            bres = s.search(qobj, limit=max(pool, top_k*6))
+            br = { r["doc_id"]: i+1 for i,r in enumerate(bres) }
+        return br
+
+    # both sides are independent: overlap FAISS CPU with Whoosh disk I/O
+    want_vec = signal in ("hybrid","faiss","chroma")
+    want_bm25 = signal in ("hybrid","bm25")
+    if want_vec and want_bm25:
+        vranks, branks = await asyncio.gather(
+            asyncio.to_thread(vector_search), asyncio.to_thread(bm25_search))
+    elif want_vec:
+        vranks = await asyncio.to_thread(vector_search)
+    elif want_bm25:
+        branks = await asyncio.to_thread(bm25_search)
 
     # --- Fuse candidates via RRF (union) ---
-    fused = rrf_union(([vranks] if vranks else []) + ([branks] if branks else []), k=60)
+    fused = rrf_union(([vranks] if vranks else []) + ([branks] if branks else []),
+                      k=60, limit=max(pool, top_k*6))
     if not fused:
         return {
             "query": q, "app": app_name, "top_k": top_k,
@@ -199,10 +326,11 @@ def retrieve(
             cand_meta.append(id2meta[did])
 
     # --- Keyword/phrase filter & coverage ---
-    req_need = (min_hits if min_hits>0 else len(req_terms))
+    # (still needed: vector-side candidates never went through the Whoosh filter)
+    cov_pairs = [coverage_score(doc or "", req_terms, req_phrases, proximity, req_phrase_tokens)
+                 for doc in cand_docs]
     filt_ids, filt_docs, filt_meta, cov_scores, cov_dbg = [], [], [], [], []
-    for did, doc, meta in zip(cand_ids, cand_docs, cand_meta):
-        cov, dbg = coverage_score(doc or "", req_terms, req_phrases, proximity)
+    for (did, doc, meta), (cov, dbg) in zip(zip(cand_ids, cand_docs, cand_meta), cov_pairs):
         enough_tokens = True
         if req_terms:
             hits = set(dbg.get("token_hits", []))
@@ -214,16 +342,20 @@ def retrieve(
             filt_ids.append(did); filt_docs.append(doc); filt_meta.append(meta)
             cov_scores.append(cov); cov_dbg.append(dbg)
     if not filt_ids:
-        # fall back without hard filter
+        # fall back without hard filter, reusing the scores already computed
         filt_ids, filt_docs, filt_meta = cand_ids, cand_docs, cand_meta
-        for d in filt_docs:
-            sc, db = coverage_score(d or "", req_terms, req_phrases, proximity)
-            cov_scores.append(sc); cov_dbg.append(db)
+        cov_scores = [p[0] for p in cov_pairs]
+        cov_dbg = [p[1] for p in cov_pairs]
 
     # --- Vectorize shortlist & MMR with coverage blend ---
     cand_vecs = _pipe_transform([d or "" for d in filt_docs])  # preview re-embed
-    qv_np = _pipe_transform([q])[0]
-    sim = (cand_vecs @ qv_np) / (np.linalg.norm(cand_vecs,axis=1)*np.linalg.norm(qv_np)+1e-9)
+    # unit vectors both sides: inner product == cosine; use FAISS's SIMD kernel
+    if len(cand_vecs):
+        D, I = faiss.knn(qv_mat, cand_vecs, len(cand_vecs), metric=faiss.METRIC_INNER_PRODUCT)
+        sim = np.empty(len(cand_vecs), dtype=np.float32)
+        sim[I[0]] = D[0]
+    else:
+        sim = np.zeros(0, dtype=np.float32)
     blended = 0.8*sim + 0.2*np.array(cov_scores, dtype="float32")
     order = np.argsort(-blended)[:max(top_k*3, 16)]
     mmr_idx = mmr(cand_vecs[order], qv_np, top_n=min(top_k, len(order)))
@@ -256,13 +388,22 @@ def retrieve(
 
 @app.get("/neighbors")
 def neighbors(app_name: str = Query("claims"), source_path: str = Query(...), seq_idx: int = Query(...), radius: int = Query(1), limit: int = Query(10)):
-    coll = client.get_or_create_collection(pick_collection(app_name))
-    res = coll.query(query_texts=["*"], n_results=1000, where={"app": app_name})
-    ids, docs, metas = res["ids"][0], res["documents"][0], res["metadatas"][0]
+    coll = get_collection(app_name)
+    # filter server-side on source_path AND the seq window; an unbounded get
+    # capped by limit would return chunks in id order, not seq order, and
+    # silently miss the window for files with many chunks
+    res = coll.get(
+        where={"$and": [
+            {"app": app_name}, {"source_path": source_path},
+            {"seq_idx": {"$gte": int(seq_idx) - int(radius)}},
+            {"seq_idx": {"$lte": int(seq_idx) + int(radius)}},
+        ]}
+    )
+    ids, docs, metas = res.get("ids",[]), res.get("documents",[]), res.get("metadatas",[])
     out=[]
     for i,(id_,m) in enumerate(zip(ids,metas)):
         try:
-            if m.get("source_path")==source_path and abs(int(m.get("seq_idx",-999))-int(seq_idx))<=int(radius):
+            if abs(int(m.get("seq_idx",-999))-int(seq_idx))<=int(radius):
                 out.append({"id": id_, "document": docs[i], "metadata": m})
         except: pass
         if len(out)>=limit: break
@@ -270,7 +411,7 @@ def neighbors(app_name: str = Query("claims"), source_path: str = Query(...), se
 
 @app.post("/by_ids")
 def by_ids(app_name: str = Query("claims"), ids: List[str] = Query(...)):
-    coll = client.get_or_create_collection(pick_collection(app_name))
+    coll = get_collection(app_name)
     res = coll.get(ids=list(ids))
     out=[]
     for id_, doc, meta in zip(res.get("ids",[]), res.get("documents",[]), res.get("metadatas",[])):
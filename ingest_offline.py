@@ -1,14 +1,21 @@
 # C:\chroma_stack\ingest\ingest_offline.py
 from __future__ import annotations
-import os, sys, re, json, time, pickle, hashlib, datetime as dt
+import os, sys, re, json, pickle, hashlib, queue, threading, datetime as dt
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
-from typing import Dict, Any, List, Iterable
+from typing import Dict, Any, List, Iterable, Tuple
 
 import yaml, numpy as np, chromadb
 from chromadb.errors import InvalidDimensionError
 from pypdf import PdfReader
 from docx import Document
 
+# optional: C-backed PDF text extraction, ~3-5x pypdf; fall back if absent
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 # local
 from hierarchy import derive_hierarchy
 from chunking import chunk_structured
@@ -23,42 +30,90 @@ CFG_PATH   = BASE / "ingest" / "config.yaml"
 EMB_PATH   = BASE / "models" / "tfidf_svd_384.pkl"
 WHOOSH_DIR = BASE / "data" / "whoosh"
 FAISS_DIR  = BASE / "faiss"
+CACHE_DIR  = BASE / "cache"
 
 # ------------ settings ------------
-BATCH_SIZE = 256
+BATCH_SIZE = 1024
 PREVIEW_CHARS = 600
 PDF_MAX_PAGES = 1500
-SLEEP_BETWEEN_BATCHES = 0.05
+UPLOAD_WORKERS = 4
+MAX_INFLIGHT_UPLOADS = 8
+HNSW_MIN_ROWS = 10000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+IVFPQ_MIN_ROWS = 200000
+IVFPQ_NLIST = 1024
+IVFPQ_PQ_M = 48
+IVFPQ_NBITS = 8
+IVFPQ_TRAIN_SAMPLE = 50000
+PARSE_WORKERS = int(os.environ.get("INGEST_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+BM25_BATCH = 500
+BM25_QUEUE_DEPTH = 8
 
 # ------------ dedupe helpers ------------
 _ws = re.compile(r"\s+")
 _boiler = re.compile(r"(^\s*page\s+\d+\s*$)|(^\s*confidential\s*$)", re.I | re.M)
+_simtok = re.compile(r"\b[\w\-]+\b")
 
 def normalize_for_hash(text: str) -> str:
-    t = _boiler.sub(" ", text)
-    t = t.lower()
-    t = _ws.sub(" ", t).strip()
-    return t
-
-def chunk_sha256(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    t = text.lower()
+    # most chunks carry no boilerplate: a memchr-fast containment check
+    # skips the expensive multiline sub for them (~2x on clean text)
+    if "page" in t or "confidential" in t:
+        t = _boiler.sub(" ", t)
+    return _ws.sub(" ", t).strip()
+
+def chunk_hash(text: str) -> str:
+    # content-addressable dedupe id, no security requirement: blake2b is
+    # ~2x sha256 in pure stdlib; same 64-hex-char output
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=32).hexdigest()
+
+def _simhash_tokens(tokens: List[str], n: int = 64) -> int:
+    if not tokens: return 0
+    # blake2b is ~2x md5 per token; bit voting runs vectorized instead of
+    # the 64-iteration Python loop per token
+    buf = b"".join(hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest() for w in tokens)
+    bits = np.unpackbits(np.frombuffer(buf, dtype=np.uint8), bitorder="little").reshape(len(tokens), n)
+    ones = bits.sum(axis=0, dtype=np.int64)
+    out_bits = (2*ones >= len(tokens)).astype(np.uint8)  # votes >= 0
+    return int.from_bytes(np.packbits(out_bits, bitorder="little").tobytes(), "little")
 
 def simhash(text: str, n=64) -> int:
-    tokens = [w for w in re.findall(r"\b[\w\-]+\b", text.lower()) if w]
-    if not tokens: return 0
-    v = [0]*n
-    for w in tokens:
-        h = int(hashlib.md5(w.encode("utf-8")).hexdigest(), 16)
-        for i in range(n):
-            v[i] += 1 if ((h >> i) & 1) else -1
-    out = 0
-    for i in range(n):
-        if v[i] >= 0: out |= (1 << i)
-    return out
+    return _simhash_tokens(_simtok.findall(text.lower()), n)
 
 def hamming(a: int, b: int) -> int:
     return (a ^ b).bit_count()
 
+# Banded simhash index: 4 bands of 16 bits. Any pair within hamming
+# distance 3 shares at least one identical band (pigeonhole), so a dict
+# lookup per band yields a small candidate set instead of scanning every
+# prior simhash.
+SIM_BANDS = 4
+SIM_BAND_BITS = 64 // SIM_BANDS
+SIM_MAX_DIST = 3
+
+def _sim_bands(sh: int) -> List[int]:
+    return [(sh >> (SIM_BAND_BITS*i)) & 0xFFFF for i in range(SIM_BANDS)]
+
+# byte-wise popcount lookup for vectorized hamming over candidate sets
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def simhash_near_dup(bands: List[Dict[int, List[int]]], sh: int, max_dist: int = SIM_MAX_DIST) -> bool:
+    cand: set[int] = set()
+    for i, b in enumerate(_sim_bands(sh)):
+        cand.update(bands[i].get(b, ()))
+    if len(cand) <= 16:
+        return any(hamming(sh, prev) <= max_dist for prev in cand)
+    # large candidate sets (boilerplate-heavy corpora): XOR + table-lookup
+    # popcount in C beats the per-int Python loop
+    x = np.bitwise_xor(np.fromiter(cand, dtype=np.uint64, count=len(cand)), np.uint64(sh))
+    d = _POPCOUNT8[x.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+    return bool((d <= max_dist).any())
+
+def simhash_insert(bands: List[Dict[int, List[int]]], sh: int) -> None:
+    for i, b in enumerate(_sim_bands(sh)):
+        bands[i].setdefault(b, []).append(sh)
+
 # ------------ utils ------------
 def utc_now() -> str:
     return dt.datetime.utcnow().isoformat(timespec="seconds") + "Z"
@@ -85,6 +140,11 @@ def load_text(path: str) -> str:
         log(f"  ! error reading {path}: {e}"); return ""
 
 def load_pdf_text(path: str) -> str:
+    if pdfium is not None:
+        try:
+            return _load_pdf_text_pdfium(path)
+        except Exception as e:
+            log(f"  ! pdfium failed on {path} ({e}), retrying with pypdf")
     out: List[str] = []
     with open(path, "rb") as f:
         r = PdfReader(f); n = min(len(r.pages), PDF_MAX_PAGES)
@@ -94,6 +154,22 @@ def load_pdf_text(path: str) -> str:
             if txt.strip(): out.append(txt)
     return "\n".join(out)
 
+def _load_pdf_text_pdfium(path: str) -> str:
+    out: List[str] = []
+    doc = pdfium.PdfDocument(path)
+    try:
+        n = min(len(doc), PDF_MAX_PAGES)
+        for i in range(n):
+            page = doc[i]
+            try:
+                txt = page.get_textpage().get_text_range() or ""
+            except Exception:
+                txt = ""
+            if txt.strip(): out.append(txt)
+    finally:
+        doc.close()
+    return "\n".join(out)
+
 def load_docx_text(path: str) -> str:
     with open(path, "rb") as f:
         d = Document(f)
@@ -103,24 +179,125 @@ def load_docx_text(path: str) -> str:
 class Embedder:
     def __init__(self, pipe):
         self.pipe = pipe
+        # unpack tfidf + SVD components so batches project sparse->384 dense
+        # directly, skipping the (batch x vocab) dense intermediate
+        try:
+            self.tfidf = pipe.steps[0][1]
+            self.svd_T = pipe.steps[-1][1].components_.T.astype(np.float32).copy(order="C")
+        except (AttributeError, IndexError):
+            self.tfidf = None; self.svd_T = None
         probe = self._transform(["probe"])
         self.dim = int(probe.shape[1])
 
     def _transform(self, texts: List[str]):
+        if self.tfidf is not None:
+            return np.asarray(self.tfidf.transform(texts) @ self.svd_T)
         m = self.pipe.transform(texts)
         if hasattr(m, "toarray"): m = m.toarray()
         return m
 
     def embed_list(self, texts: List[str]) -> List[List[float]]:
-        arr = self._transform(texts).astype(np.float32)
-        norms = np.linalg.norm(arr, axis=1, keepdims=True) + 1e-9
-        arr = arr / norms
-        return [row.tolist() for row in arr]
+        return self.embed_array(texts).tolist()
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        arr = self._transform(texts).astype(np.float32, copy=False)
+        arr /= (np.linalg.norm(arr, axis=1, keepdims=True) + 1e-9)
+        return arr
 
 # ------------ batching ------------
 def batched(seq: List[Any], n: int) -> Iterable[List[Any]]:
     for i in range(0, len(seq), n): yield seq[i:i+n]
 
+class Bm25Batch:
+    """Columnar BM25 staging (struct-of-arrays): five flat lists instead of a
+    dict per chunk; Whoosh document dicts are built just-in-time in the writer."""
+    __slots__ = ("doc_ids", "apps", "titles", "texts", "sources")
+
+    def __init__(self):
+        self.doc_ids: List[str] = []; self.apps: List[str] = []
+        self.titles: List[str] = []; self.texts: List[str] = []
+        self.sources: List[str] = []
+
+    def append(self, doc_id: str, app: str, title: str, text: str, source: str) -> None:
+        self.doc_ids.append(doc_id); self.apps.append(app)
+        self.titles.append(title); self.texts.append(text)
+        self.sources.append(source)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def rows(self) -> Iterable[Dict[str, Any]]:
+        for d, a, t, x, s in zip(self.doc_ids, self.apps, self.titles, self.texts, self.sources):
+            yield {"doc_id": d, "app": a, "title": t, "text": x, "source": s}
+
+class VecBuf:
+    """Doubling float32 matrix buffer: batches write in place, so the FAISS
+    build reads a single contiguous view with no list-of-batches + vstack copy."""
+    def __init__(self, dim: int):
+        self.buf = np.empty((4096, dim), np.float32)
+        self.n = 0
+
+    def add(self, arr: np.ndarray) -> None:
+        need = self.n + len(arr)
+        if need > len(self.buf):
+            new = np.empty((max(len(self.buf)*2, need), self.buf.shape[1]), np.float32)
+            new[:self.n] = self.buf[:self.n]
+            self.buf = new
+        self.buf[self.n:need] = arr
+        self.n = need
+
+    def view(self) -> np.ndarray:
+        return self.buf[:self.n]
+
+# ------------ per-file worker (runs in the process pool) ------------
+def _file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def parse_file(full: str, root: Dict[str, Any], chunk_tokens: int, chunk_overlap: int,
+               use_cache: bool = True) -> List[Dict[str, Any]]:
+    """Parse + chunk + hash one file. Dedupe stays global, in the driver."""
+    # parse cache: keyed by file content + chunk config, so unchanged files
+    # on re-runs skip PDF/docx extraction, chunking and hashing entirely
+    cache_path = None
+    if use_cache:
+        try:
+            key = f"{_file_digest(full)}_{chunk_tokens}_{chunk_overlap}"
+            cache_path = CACHE_DIR / f"{key}.json"
+            if cache_path.exists():
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            cache_path = None
+
+    text = load_text(full)
+    if not text.strip(): return []
+    chs = chunk_structured(text, chunk_tokens, chunk_overlap)
+    if not chs: return []
+    base_meta = derive_hierarchy(root, full)
+    out: List[Dict[str, Any]] = []
+    for ch in chs:
+        piece = (ch["body"] or "").strip()
+        if not piece: continue
+        norm = normalize_for_hash(piece)  # already lowercased
+        out.append({
+            "piece": piece, "hid": chunk_hash(norm), "simhash": _simhash_tokens(_simtok.findall(norm)),
+            "title": ch.get("title") or "", "seq_idx": int(ch.get("seq_idx", 0)),
+            "base_meta": base_meta,
+        })
+    if cache_path is not None:
+        try:
+            tmp = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(out, f, ensure_ascii=False)
+            os.replace(tmp, cache_path)  # atomic even with parallel workers
+        except OSError:
+            pass
+    return out
+
 # ------------ main ------------
 def main():
     if not CFG_PATH.exists(): raise SystemExit(f"Missing config: {CFG_PATH}")
@@ -141,10 +318,15 @@ def main():
 
     WHOOSH_DIR.mkdir(parents=True, exist_ok=True)
     FAISS_DIR.mkdir(parents=True, exist_ok=True)
+    use_cache = bool(cfg.get("incremental", True))
+    if use_cache: CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # dual_write=False keeps Chroma authoritative during ingest and re-pulls
+    # embeddings afterwards for the FAISS build, halving accumulator RAM
+    dual_write = bool(cfg.get("dual_write", True))
 
     # Dedupe caches
     seen_hashes: set[str] = set()
-    seen_simhashes: List[int] = []
+    seen_sim_bands: List[Dict[int, List[int]]] = [{} for _ in range(SIM_BANDS)]
     exact_dups_skipped = 0
     near_dups_skipped  = 0
 
@@ -155,8 +337,14 @@ def main():
         return whoosh_ix_by_app[app]
 
     # For FAISS (per app) we collect vectors & aligned ids
-    faiss_vectors_by_app: Dict[str, List[List[float]]] = {}
+    faiss_vectors_by_app: Dict[str, VecBuf] = {}
     faiss_ids_by_app: Dict[str, List[str]] = {}
+    colls_by_app: Dict[str, Any] = {}
+
+    # Chroma upload pipeline: a few inflight adds keep the server busy while
+    # the driver embeds the next batch (replaces the old fixed sleep)
+    upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    inflight: set = set()
 
     for coll_cfg in cfg["collections"]:
         coll_name = coll_cfg["name"]; app = coll_cfg["app"]
@@ -168,16 +356,37 @@ def main():
             )
         except InvalidDimensionError as e:
             raise SystemExit(f"Incompatible Chroma dim for '{coll_name}'. Delete/recreate. {e}")
+        colls_by_app[app] = coll
+
+        # create per-app holders before any skip so the post-ingest FAISS
+        # pull can iterate every registered collection safely
+        faiss_vectors_by_app.setdefault(app, VecBuf(emb.dim))
+        faiss_ids_by_app.setdefault(app, [])
 
-        ix = ix_for(app); to_upsert_bm25: List[Dict[str, Any]] = []
+        ix = ix_for(app); to_upsert_bm25 = Bm25Batch()
         file_count = chunk_count = 0
         roots = [r for r in cfg["roots"] if r.get("app")==app]
         if not roots: log(f"  ! No roots for app '{app}', skip"); continue
 
-        # create per-app holders
-        faiss_vectors_by_app.setdefault(app, [])
-        faiss_ids_by_app.setdefault(app, [])
-
+        # single background writer: Whoosh segment commits overlap parsing
+        # and embedding instead of stalling the driver at every flush
+        bm25_q: queue.Queue = queue.Queue(maxsize=BM25_QUEUE_DEPTH)
+
+        def bm25_writer(ix=ix, q=bm25_q):
+            while True:
+                batch = q.get()
+                if batch is None: return
+                try:
+                    upsert(ix, list(batch.rows())); log(f"  [BM25] committed {len(batch)} docs")
+                except Exception as e:
+                    log(f"  ! BM25 upsert failed ({len(batch)} docs): {e}")
+
+        bm25_thread = threading.Thread(target=bm25_writer, daemon=True)
+        bm25_thread.start()
+
+        # gather candidate files first, then parse+chunk+hash them in parallel;
+        # dedupe, embedding and uploads stay in this process
+        work: List[Tuple[str, Dict[str, Any]]] = []
         for root in roots:
             root_path = root["path"]; log(f"  Walking: {root_path}")
             for dirpath, _, files in os.walk(root_path):
@@ -186,90 +395,155 @@ def main():
                     ext = os.path.splitext(full)[1].lower()
                     if ext not in include_exts: continue
                     size = safe_file_size(full)
-                    if size is None or size > max_bytes: 
+                    if size is None or size > max_bytes:
                         if size and size>max_bytes: log(f"  - skip (>{cfg.get('max_mb',25)}MB): {full}")
                         continue
-
-                    text = load_text(full)
-                    if not text.strip(): continue
-
-                    chs = chunk_structured(text, cfg["chunk"]["tokens"], cfg["chunk"]["overlap"])
-                    if not chs: continue
-
-                    ids: List[str] = []; docs: List[str] = []; metas: List[Dict[str,Any]] = []; payload_texts: List[str] = []
-                    base_meta = derive_hierarchy(root, full)
-
-                    for ch in chs:
-                        piece = (ch["body"] or "").strip()
-                        if not piece: continue
-                        norm = normalize_for_hash(piece)
-                        hid  = chunk_sha256(norm)
-                        if hid in seen_hashes:
-                            exact_dups_skipped += 1; continue
-                        sh   = simhash(norm)
-                        if any(hamming(sh, prev) <= 3 for prev in seen_simhashes):
-                            near_dups_skipped += 1; continue
-                        seen_hashes.add(hid); seen_simhashes.append(sh)
-
-                        cid = f"h:{hid}"
-                        ids.append(cid)
-                        docs.append(piece[:PREVIEW_CHARS])
-                        meta = {
-                            **base_meta, "kind":"doc","app":app,"source_path":full,
-                            "section_title": ch.get("title") or "", "seq_idx": int(ch.get("seq_idx",0)),
-                            "ingested_at": utc_now(), "hash": hid, "simhash": sh
-                        }
-                        metas.append(meta)
-                        payload_texts.append(piece)
-
-                    if not ids: continue
-
-                    # embed & upload to Chroma (batched)
-                    for b_ids, b_docs, b_metas, b_texts in zip(
-                        batched(ids, BATCH_SIZE), batched(docs, BATCH_SIZE),
-                        batched(metas, BATCH_SIZE), batched(payload_texts, BATCH_SIZE)
-                    ):
-                        vecs = emb.embed_list(b_texts)  # normalized
-                        coll.add(ids=list(b_ids), documents=list(b_docs), metadatas=list(b_metas), embeddings=vecs)
-                        # collect for FAISS (keep same order)
-                        faiss_vectors_by_app[app].extend(vecs)
-                        faiss_ids_by_app[app].extend(list(b_ids))
-                        time.sleep(SLEEP_BETWEEN_BATCHES)
+                    work.append((full, root))
+
+        # cross-file embedding buffer: small files no longer issue tiny
+        # pipe.transform calls — every flush sees a full BATCH_SIZE batch
+        pend_ids: List[str] = []; pend_docs: List[str] = []
+        pend_metas: List[Dict[str,Any]] = []; pend_texts: List[str] = []
+
+        def flush_pending():
+            nonlocal inflight
+            if not pend_ids: return
+            vecs = emb.embed_array(pend_texts)  # normalized float32 (batch, dim)
+            # hand Chroma the float32 ndarray directly; the client's numpy
+            # fast path skips materializing batch*dim Python floats
+            inflight.add(upload_pool.submit(
+                coll.add, ids=list(pend_ids), documents=list(pend_docs),
+                metadatas=list(pend_metas),
+                embeddings=np.ascontiguousarray(vecs, dtype=np.float32)))
+            if len(inflight) >= MAX_INFLIGHT_UPLOADS:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                for f in done: f.result()
+            # collect for FAISS (keep same order) as whole batch arrays
+            if dual_write:
+                faiss_vectors_by_app[app].add(vecs)
+                faiss_ids_by_app[app].extend(pend_ids)
+            pend_ids.clear(); pend_docs.clear(); pend_metas.clear(); pend_texts.clear()
+
+        with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+            futures = {
+                pool.submit(parse_file, full, root, cfg["chunk"]["tokens"], cfg["chunk"]["overlap"], use_cache): full
+                for full, root in work
+            }
+            for fut in as_completed(futures):
+                full = futures[fut]
+                try:
+                    records = fut.result()
+                except Exception as e:
+                    log(f"  ! error parsing {full}: {e}"); continue
+                if not records: continue
+
+                kept = 0
+                for rec in records:
+                    hid = rec["hid"]
+                    if hid in seen_hashes:
+                        exact_dups_skipped += 1; continue
+                    sh = rec["simhash"]
+                    if simhash_near_dup(seen_sim_bands, sh):
+                        near_dups_skipped += 1; continue
+                    seen_hashes.add(hid); simhash_insert(seen_sim_bands, sh)
+
+                    cid = f"h:{hid}"
+                    meta = {
+                        **rec["base_meta"], "kind":"doc","app":app,"source_path":full,
+                        "section_title": rec["title"], "seq_idx": rec["seq_idx"],
+                        "ingested_at": utc_now(), "hash": hid, "simhash": sh
+                    }
+                    pend_ids.append(cid)
+                    pend_docs.append(rec["piece"][:PREVIEW_CHARS])
+                    pend_metas.append(meta)
+                    pend_texts.append(rec["piece"])
+                    kept += 1
 
                     # Whoosh stage (raw text)
-                    for i, piece in enumerate(payload_texts):
-                        to_upsert_bm25.append({
-                            "doc_id": ids[i], "app": app,
-                            "title": metas[i]["section_title"] or "",
-                            "text": piece, "source": metas[i]["source_path"]
-                        })
+                    to_upsert_bm25.append(cid, app, meta["section_title"] or "",
+                                          rec["piece"], full)
+
+                if not kept: continue
 
-                    file_count += 1; chunk_count += len(ids)
-                    log(f"    + {len(ids):4d} chunks   {full}")
+                if len(pend_ids) >= BATCH_SIZE:
+                    flush_pending()
 
-                    if len(to_upsert_bm25) >= 5000:
-                        upsert(ix, to_upsert_bm25); log(f"  [BM25] committed {len(to_upsert_bm25)} docs"); to_upsert_bm25.clear()
+                file_count += 1; chunk_count += kept
+                log(f"    + {kept:4d} chunks   {full}")
 
-        if to_upsert_bm25:
-            upsert(ix, to_upsert_bm25); log(f"  [BM25] committed {len(to_upsert_bm25)} docs")
+                if len(to_upsert_bm25) >= BM25_BATCH:
+                    bm25_q.put(to_upsert_bm25); to_upsert_bm25 = Bm25Batch()
+
+        flush_pending()
+
+        # surface upload failures before moving to the next collection
+        for f in inflight: f.result()
+        inflight.clear()
+
+        if len(to_upsert_bm25):
+            bm25_q.put(to_upsert_bm25)
+        bm25_q.put(None); bm25_thread.join()
 
         log(f"=== done: files={file_count}, chunks={chunk_count} ===")
 
+    upload_pool.shutdown(wait=True)
+
+    if not dual_write:
+        # stream the vectors back out of Chroma in pages for the FAISS build
+        for app, coll in colls_by_app.items():
+            vb = faiss_vectors_by_app[app]; ids = faiss_ids_by_app[app]
+            offset = 0
+            while True:
+                got = coll.get(include=["embeddings"], limit=10000, offset=offset)
+                g_ids = got.get("ids") or []
+                if not g_ids: break
+                vb.add(np.asarray(got["embeddings"], dtype=np.float32))
+                ids.extend(g_ids); offset += len(g_ids)
+            log(f"[FAISS] pulled {len(ids)} embeddings from Chroma for app={app}")
+
     # Build/save FAISS indexes per app
-    for app, vecs in faiss_vectors_by_app.items():
+    for app, vb in faiss_vectors_by_app.items():
         ids = faiss_ids_by_app.get(app, [])
-        if not vecs or not ids:
+        if not vb.n or not ids:
             log(f"[FAISS] skip app={app} (no vectors)")
             continue
-        arr = np.array(vecs, dtype="float32")
+        arr = vb.view()
         dim = arr.shape[1]
-        index = faiss.IndexFlatIP(dim)  # cosine (vectors already L2-normalized)
+        # fp16 storage halves RAM/bandwidth vs IndexFlatIP; inner product on
+        # L2-normalized vectors == cosine, queries stay float32.
+        # Past HNSW_MIN_ROWS a graph index gives sub-linear search with no
+        # training corpus requirements; below it flat scan is already fast.
+        # Past IVFPQ_MIN_ROWS product quantization (~pq_m bytes/vector) keeps
+        # the index in RAM where fp16 graph storage would not.
+        # cfg faiss_quant (flat|fp16|sq8|ivf_pq) pins a tier; default "auto"
+        # keeps the size-based choice above.
+        quant = str(cfg.get("faiss_quant", "auto")).lower()
+        train = arr
+        if quant == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif quant == "fp16":
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        elif quant == "sq8":
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        elif quant == "ivf_pq" or len(ids) >= IVFPQ_MIN_ROWS:
+            pq_m = next(m for m in (IVFPQ_PQ_M, 32, 24, 16, 8, 4, 2, 1) if dim % m == 0)
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, IVFPQ_NLIST, pq_m, IVFPQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+            if len(arr) > IVFPQ_TRAIN_SAMPLE:
+                pick = np.random.default_rng(0).choice(len(arr), IVFPQ_TRAIN_SAMPLE, replace=False)
+                train = np.ascontiguousarray(arr[pick])
+        elif len(ids) >= HNSW_MIN_ROWS:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        else:
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        index.train(train)
         index.add(arr)
         out_idx = FAISS_DIR / f"{app}.faiss"
-        out_ids = FAISS_DIR / f"{app}_ids.json"
+        out_ids = FAISS_DIR / f"{app}_ids.npy"
         faiss.write_index(index, str(out_idx))
-        with open(out_ids, "w", encoding="utf-8") as f:
-            json.dump(ids, f, ensure_ascii=False)
+        # fixed-width bytes: ~3x smaller than JSON, loads via mmap at serve time
+        np.save(out_ids, np.array(ids, dtype="S"))
         log(f"[FAISS] wrote {out_idx} and {out_ids} (rows={len(ids)}, dim={dim})")
 
     log(f"  [dedupe] exact_skipped={exact_dups_skipped} near_skipped={near_dups_skipped}")
@@ -1,7 +1,9 @@
 # C:\chroma_stack\mcp\rag_mcp.py
-# pip install fastmcp requests
-import os, json, requests
-from typing import List, Optional
+# pip install fastmcp httpx
+import asyncio, atexit, hashlib, os, json, random, re, sys, time
+from collections import OrderedDict, deque
+import httpx
+from typing import List, Optional, Tuple
 from fastmcp import FastMCP, tool
 
 RAG_BASE  = os.environ.get("RAG_BASE", "http://127.0.0.1:8091")
@@ -9,10 +11,168 @@ MEM_URL   = os.environ.get("MEM_URL",  "http://127.0.0.1:8080/memory/append")
 MEM_TOKEN = os.environ.get("MEM_TOKEN", "super-secret-token")
 TIMEOUT_S = float(os.environ.get("MCP_HTTP_TIMEOUT", "60"))
 
+# optional: C JSON serializer (~3-5x stdlib on big retrieval payloads)
+try:
+    import orjson
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+# pooled keep-alive clients shared by all tools; async so concurrent tool
+# calls overlap on the event loop instead of serializing on a blocking socket
+_rag = httpx.AsyncClient(
+    base_url=RAG_BASE, timeout=TIMEOUT_S,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30))
+# gateway auth header attached once at the client, not per call
+_mem = httpx.AsyncClient(timeout=TIMEOUT_S, headers={"X-Token": MEM_TOKEN})
+
+def _close_clients():
+    try:
+        asyncio.run(_rag.aclose())
+        asyncio.run(_mem.aclose())
+    except Exception:
+        pass
+atexit.register(_close_clients)
+
+class _TTLCache:
+    """Small LRU+TTL cache for serialized tool responses. All access happens
+    on the single asyncio loop with no awaits in between, so no lock needed."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize; self.ttl = ttl
+        self._d: "OrderedDict[Tuple, Tuple[float, str]]" = OrderedDict()
+
+    def get(self, key) -> Optional[str]:
+        item = self._d.get(key)
+        if item is None: return None
+        ts, val = item
+        if time.monotonic() - ts > self.ttl:
+            del self._d[key]; return None
+        self._d.move_to_end(key)
+        return val
+
+    def put(self, key, val: str) -> None:
+        self._d[key] = (time.monotonic(), val)
+        self._d.move_to_end(key)
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def drop(self, key) -> None:
+        self._d.pop(key, None)
+
+    def drop_app(self, app: str) -> None:
+        # keys lead with app_name so a memory write can invalidate one app
+        for k in [k for k in self._d if k[0] == app]:
+            del self._d[k]
+
+_retrieve_cache  = _TTLCache(maxsize=512, ttl=300.0)
+_neighbors_cache = _TTLCache(maxsize=512, ttl=60.0)
+_by_ids_cache    = _TTLCache(maxsize=512, ttl=60.0)
+
+# approximate query cache: rephrasings like "patient claim denied" vs
+# "denied patient claim" share the cached result when token-set Jaccard
+# similarity clears the threshold and all other params match. A linear scan
+# of <=256 frozensets is microseconds — no MinHash dependency needed.
+_QTOK = re.compile(r"\w+")
+
+def _norm(q: str) -> str:
+    # case/whitespace-insensitive exact-cache key; the upstream call still
+    # gets the query as typed
+    return " ".join(q.lower().split())
+
+_SEM_TAU = 0.85
+_sem_entries: "deque[Tuple[Tuple, frozenset, str]]" = deque(maxlen=256)
+
+def _sem_lookup(params_key: Tuple, qtokens: frozenset) -> Optional[str]:
+    if not qtokens: return None
+    for pk, toks, text in reversed(_sem_entries):
+        if pk != params_key or not toks: continue
+        inter = len(qtokens & toks)
+        if inter and inter / len(qtokens | toks) >= _SEM_TAU:
+            return text
+    return None
+
+def _sem_drop_app(app: str) -> None:
+    global _sem_entries
+    _sem_entries = deque((e for e in _sem_entries if e[0][0] != app), maxlen=256)
+
+# bounded retries with jittered backoff on read-only RAG calls, plus a small
+# circuit breaker so a dead upstream fails fast instead of stalling every
+# tool call on timeouts while the agent piles on LLM-level retries
+_RETRY_ATTEMPTS = 3
+_BREAKER_FAIL_MAX = 5
+_BREAKER_RESET_S = 30.0
+_breaker = {"fails": 0, "open_until": 0.0}
+
+async def _rag_call(method: str, path: str, **kw) -> httpx.Response:
+    if time.monotonic() < _breaker["open_until"]:
+        raise RuntimeError(f"RAG upstream circuit open; retrying after {_BREAKER_RESET_S:.0f}s")
+    last_exc: Optional[Exception] = None
+    for attempt in range(_RETRY_ATTEMPTS):
+        try:
+            r = await _rag.request(method, path, **kw)
+            if r.status_code >= 500:
+                raise httpx.HTTPStatusError(
+                    f"upstream {r.status_code}", request=r.request, response=r)
+            _breaker["fails"] = 0
+            return r  # 4xx is the caller's problem, not a transient fault
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            last_exc = e
+            _breaker["fails"] += 1
+            if _breaker["fails"] >= _BREAKER_FAIL_MAX:
+                _breaker["open_until"] = time.monotonic() + _BREAKER_RESET_S
+                break
+            if attempt + 1 < _RETRY_ATTEMPTS:
+                await asyncio.sleep(min(2.0, 0.1 * 2**attempt) * (0.5 + random.random()))
+    assert last_exc is not None
+    raise last_exc
+
+# hard input caps: a looping agent asking for top_k=10000 would otherwise
+# DoS the upstream and this process through JSON allocation alone
+_MAX_TOP_K   = 64
+_MAX_POOL    = 256
+_MAX_IDS     = 256
+_MAX_RADIUS  = 16
+_MAX_LIMIT   = 100
+_MAX_Q_CHARS = 4096
+_MAX_TEXT_CHARS = 16384
+
 mcp = FastMCP("rag-tools")
 
+async def _retrieve_impl(q: str, app_name: str, top_k: int, pool: int, signal: str,
+                         reembed_previews: bool, must: str, must_phrases: str,
+                         min_hits: int, proximity: int, no_cache: bool) -> str:
+    q = q[:_MAX_Q_CHARS]
+    top_k = min(int(top_k), _MAX_TOP_K)
+    pool = min(int(pool), _MAX_POOL)
+    pk = (app_name, top_k, pool, signal, reembed_previews,
+          must, must_phrases, min_hits, proximity)
+    key = pk + (_norm(q),)
+    qtokens = frozenset(_QTOK.findall(q.lower()))
+    if not no_cache:
+        hit = _retrieve_cache.get(key)
+        if hit is not None: return hit
+        hit = _sem_lookup(pk, qtokens)
+        if hit is not None: return hit
+    params = {
+        "q": q, "app_name": app_name, "top_k": top_k, "pool": pool,
+        "signal": signal, "reembed_previews": json.dumps(reembed_previews),
+        "must": must, "must_phrases": must_phrases,
+        "min_hits": min_hits, "proximity": proximity
+    }
+    r = await _rag_call("GET", "/retrieve", params=params)
+    r.raise_for_status()
+    # upstream body is already the JSON we return: forward it verbatim
+    # instead of a parse + re-serialize round trip over the whole payload
+    out = r.text
+    _retrieve_cache.put(key, out)
+    _sem_entries.append((pk, qtokens, out))
+    return out
+
+
 @tool(description="Hybrid retrieve (FAISS vectors + Whoosh BM25) with keyword/phrase controls. Returns JSON string.")
-def retrieve_hybrid(
+async def retrieve_hybrid(
     q: str,
     app_name: str = "claims",
     top_k: int = 8,
@@ -23,39 +183,175 @@ def retrieve_hybrid(
     must: str = "",                    # space/comma separated required tokens
     must_phrases: str = "",            # semicolon-separated phrases
     min_hits: int = 0,                 # 0 => require all 'must' terms; else minimum
-    proximity: int = 0                 # phrase slop (0 = exact)
+    proximity: int = 0,                # phrase slop (0 = exact)
+    no_cache: bool = False             # bypass exact+semantic caches
 ) -> str:
-    params = {
-        "q": q, "app_name": app_name, "top_k": top_k, "pool": pool,
-        "signal": signal, "reembed_previews": json.dumps(reembed_previews),
-        "must": must, "must_phrases": must_phrases,
-        "min_hits": min_hits, "proximity": proximity
-    }
-    r = requests.get(f"{RAG_BASE}/retrieve", params=params, timeout=TIMEOUT_S)
+    return await _retrieve_impl(q, app_name, top_k, pool, signal, reembed_previews,
+                                must, must_phrases, min_hits, proximity, no_cache)
+
+# neighbors are cached as one widened envelope per file: incremental radius
+# walks (1, then 2, then 3...) slice the envelope locally instead of paying
+# a round trip per widening step
+_NEIGHBOR_WIDEN = 4
+
+def _slice_neighbors(rows: List[dict], seq_idx: int, radius: int, limit: int) -> str:
+    picked = []
+    for row in rows:
+        try:
+            if abs(int(row["metadata"].get("seq_idx", -999)) - seq_idx) <= radius:
+                picked.append(row)
+        except (TypeError, ValueError):
+            pass
+        if len(picked) >= limit: break
+    return _dumps({"results": picked})
+
+async def _neighbors_impl(source_path: str, seq_idx: int, app_name: str,
+                          radius: int, limit: int) -> str:
+    radius = min(int(radius), _MAX_RADIUS)
+    limit = min(int(limit), _MAX_LIMIT)
+    env = _neighbors_cache.get((app_name, source_path))
+    if env is not None:
+        center, fetched_radius, rows = env
+        if abs(seq_idx - center) + radius <= fetched_radius:
+            return _slice_neighbors(rows, seq_idx, radius, limit)
+    widened = max(radius, _NEIGHBOR_WIDEN)
+    params = {"app_name": app_name, "source_path": source_path, "seq_idx": seq_idx,
+              "radius": widened, "limit": max(limit, 2*widened + 1)}
+    r = await _rag_call("GET", "/neighbors", params=params)
     r.raise_for_status()
-    return json.dumps(r.json(), ensure_ascii=False)
+    rows = r.json().get("results", [])
+    _neighbors_cache.put((app_name, source_path), (seq_idx, widened, rows))
+    return _slice_neighbors(rows, seq_idx, radius, limit)
+
 
 @tool(description="Fetch ±radius neighbor chunks from the same file. Returns JSON string.")
-def get_neighbors(
+async def get_neighbors(
     source_path: str,
     seq_idx: int,
     app_name: str = "claims",
     radius: int = 1,
     limit: int = 10
 ) -> str:
-    params = {"app_name": app_name, "source_path": source_path, "seq_idx": seq_idx, "radius": radius, "limit": limit}
-    r = requests.get(f"{RAG_BASE}/neighbors", params=params, timeout=TIMEOUT_S)
-    r.raise_for_status()
-    return json.dumps(r.json(), ensure_ascii=False)
+    return await _neighbors_impl(source_path, seq_idx, app_name, radius, limit)
+
+@tool(description="Hybrid retrieve plus ±radius neighbor context per hit, fetched concurrently. Returns JSON string.")
+async def retrieve_with_context(
+    q: str,
+    app_name: str = "claims",
+    top_k: int = 8,
+    pool: int = 80,
+    radius: int = 1,
+    neighbor_limit: int = 10,
+    must: str = "",
+    must_phrases: str = "",
+    min_hits: int = 0,
+    proximity: int = 0
+) -> str:
+    # neighbor fetches for all hits run concurrently, so total latency is
+    # retrieve + slowest neighbor instead of retrieve + sum of neighbors
+    body = json.loads(await _retrieve_impl(q, app_name, top_k, pool, "hybrid", True,
+                                           must, must_phrases, min_hits, proximity, False))
+    hits = body.get("results", [])
+
+    async def _ctx(hit: dict) -> dict:
+        m = hit.get("metadata") or {}
+        sp, si = m.get("source_path"), m.get("seq_idx")
+        if sp is None or si is None: return {"results": []}
+        return json.loads(await _neighbors_impl(sp, int(si), app_name, radius, neighbor_limit))
+
+    ctxs = await asyncio.gather(*[_ctx(h) for h in hits], return_exceptions=True)
+    for hit, ctx in zip(hits, ctxs):
+        hit["context"] = [] if isinstance(ctx, Exception) else ctx.get("results", [])
+    return _dumps(body)
+
+# micro-batcher: get_by_ids calls landing within a 10 ms window (an agent
+# fetching chunks one id at a time) merge into a single upstream POST
+_BATCH_WINDOW_S = 0.01
+_BATCH_MAX_CALLS = 32
+_pending_by_ids: dict = {}  # app_name -> [(ids, future), ...]
+
+# /by_ids resolves the whole list in a single coll.get, so the merged batch
+# normally goes up as one POST; only very large batches are split so no
+# single request carries an unbounded payload. The semaphore caps fan-out.
+_BY_IDS_SHARD = 128
+_by_ids_sem = asyncio.Semaphore(8)
+
+async def _post_by_ids_shard(app_name: str, shard: List[str]) -> List[dict]:
+    async with _by_ids_sem:
+        r = await _rag_call("POST", "/by_ids", params={"app_name": app_name}, json={"ids": shard})
+        r.raise_for_status()
+        return r.json().get("results", [])
+
+async def _drain_by_ids(app_name: str) -> None:
+    calls = _pending_by_ids.pop(app_name, [])
+    if not calls: return
+    merged = list(dict.fromkeys(i for ids, _ in calls for i in ids))
+    shards = [merged[i:i+_BY_IDS_SHARD] for i in range(0, len(merged), _BY_IDS_SHARD)]
+    try:
+        results = await asyncio.gather(*[_post_by_ids_shard(app_name, s) for s in shards])
+        by_id = {row["id"]: row for rows in results for row in rows}
+    except asyncio.CancelledError:
+        # propagate cancellation to the waiters instead of swallowing it
+        for _, fut in calls:
+            if not fut.done(): fut.cancel()
+        raise
+    except Exception as e:
+        # anything here (HTTP errors, bad JSON, breaker RuntimeError) must
+        # reach the waiters — a swallowed failure leaves futures pending and
+        # get_by_ids hangs forever
+        for _, fut in calls:
+            if not fut.done(): fut.set_exception(e)
+        return
+    for ids, fut in calls:
+        if not fut.done():
+            fut.set_result(_dumps(
+                {"results": [by_id[i] for i in ids if i in by_id]}))
+
+async def _arm_by_ids_window(app_name: str) -> None:
+    await asyncio.sleep(_BATCH_WINDOW_S)
+    await _drain_by_ids(app_name)
 
 @tool(description="Fetch specific chunks by ids. Returns JSON string.")
-def get_by_ids(ids: List[str], app_name: str = "claims") -> str:
-    r = requests.post(f"{RAG_BASE}/by_ids", params={"app_name": app_name}, json={"ids": ids}, timeout=TIMEOUT_S)
-    r.raise_for_status()
-    return json.dumps(r.json(), ensure_ascii=False)
+async def get_by_ids(ids: List[str], app_name: str = "claims") -> str:
+    ids = ids[:_MAX_IDS]
+    key = (app_name, tuple(ids))
+    hit = _by_ids_cache.get(key)
+    if hit is not None: return hit
+    fut = asyncio.get_running_loop().create_future()
+    calls = _pending_by_ids.setdefault(app_name, [])
+    if not calls:
+        asyncio.create_task(_arm_by_ids_window(app_name))  # first caller arms the timer
+    calls.append((list(ids), fut))
+    if len(calls) >= _BATCH_MAX_CALLS:
+        await _drain_by_ids(app_name)
+    out = await fut
+    _by_ids_cache.put(key, out)
+    return out
+
+# agents in a loop re-append identical notes; a content hash with a 10 min
+# TTL suppresses the duplicate write (and its embedding) at the source
+_mem_seen = _TTLCache(maxsize=4096, ttl=600.0)
+
+# write-behind: memory appends are acked immediately and drained to the
+# gateway in the background — the agent never needs the write to be durable
+# before it continues reasoning
+_mem_queue: Optional[asyncio.Queue] = None
+_mem_worker: Optional[asyncio.Task] = None
+
+async def _mem_drain() -> None:
+    while True:
+        payload, h, app = await _mem_queue.get()
+        try:
+            r = await _mem.post(MEM_URL, json=payload)
+            r.raise_for_status()
+        except Exception as e:
+            _mem_seen.drop((app, h))  # allow a later retry to write through
+            # stderr, never stdout: the stdio transport owns stdout and a
+            # stray line would corrupt the JSON-RPC stream
+            print(f"[save_memory] write-behind failed: {e}", file=sys.stderr, flush=True)
 
 @tool(description="Append a note/feedback/decision to Chroma via memory gateway. Returns JSON string.")
-def save_memory(
+async def save_memory(
     collection: str,
     text: str,
     app: str,
@@ -66,12 +362,24 @@ def save_memory(
     kind: str = "note",
     author: str = "agent",
 ) -> str:
-    headers = {"X-Token": MEM_TOKEN}
+    global _mem_queue, _mem_worker
+    text = text[:_MAX_TEXT_CHARS]
+    h = hashlib.blake2b(f"{collection}|{app}|{text}".encode("utf-8"), digest_size=16).digest()
+    if _mem_seen.get((app, h)) is not None:
+        return '{"status": "duplicate", "skipped": true}'
     payload = {"collection": collection, "text": text, "app": app, "module": module, "submodule": submodule,
                "flow": flow, "subflow": subflow, "kind": kind, "author": author}
-    r = requests.post(MEM_URL, json=payload, headers=headers, timeout=TIMEOUT_S)
-    r.raise_for_status()
-    return json.dumps(r.json(), ensure_ascii=False)
+    if _mem_queue is None:  # first call: the loop exists now, start the worker
+        _mem_queue = asyncio.Queue(maxsize=256)
+        _mem_worker = asyncio.create_task(_mem_drain())
+    _mem_seen.put((app, h), "1")
+    # new memory may change what retrieval should surface for this app
+    _retrieve_cache.drop_app(app)
+    _neighbors_cache.drop_app(app)
+    _by_ids_cache.drop_app(app)
+    _sem_drop_app(app)
+    await _mem_queue.put((payload, h, app))
+    return '{"queued": true}'
 
 if __name__ == "__main__":
     mcp.run()